@@ -5,12 +5,21 @@ Run: uvicorn main.py --reload
 Access: http://localhost:8000
 """
 
-from fastapi import FastAPI, UploadFile, File, Header
+import os
+
+# Thread pools are sized explicitly so multiple workers don't oversubscribe the
+# CPU. OpenMP/MKL read these at import time, so set them before importing torch.
+TORCH_NUM_THREADS = int(os.getenv("TORCH_NUM_THREADS", min(4, os.cpu_count() or 1)))
+os.environ.setdefault("OMP_NUM_THREADS", str(TORCH_NUM_THREADS))
+os.environ.setdefault("MKL_NUM_THREADS", str(TORCH_NUM_THREADS))
+
+from fastapi import FastAPI, UploadFile, File, Header, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import torch
 import torch.nn as nn
 from torchvision import models
+from torchvision.models import quantization as quantizable_models
 import json
 from PIL import Image
 import io
@@ -19,14 +28,35 @@ from datetime import datetime
 from pathlib import Path
 from pytorch_grad_cam import GradCAM
 from pytorch_grad_cam.utils.model_targets import ClassifierOutputTarget
-from pytorch_grad_cam.utils.image import show_cam_on_image
+import cv2
 import base64
+import atexit
+import contextlib
+import functools
+import logging
+import asyncio
+import threading
+import collections
+import copy
+import hashlib
+
+# Optional: Intel Extension for PyTorch enables the BF16 inference path
+try:
+    import intel_extension_for_pytorch as ipex
+except ImportError:
+    ipex = None
+
+# Optional: ONNX Runtime enables the INT8 QDQ inference path
+try:
+    import onnxruntime as ort
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, quantize_static
+except ImportError:
+    ort = None
 
 # ==================== SETUP ====================
 app = FastAPI(title="HemaScan Backend", version="0.1.0")
 
 # CORS Configuration - Support both local development and production
-import os
 cors_origins = os.getenv("CORS_ORIGIN", "http://localhost:5173,http://localhost:3000").split(",")
 # Clean up any whitespace
 cors_origins = [origin.strip() for origin in cors_origins]
@@ -38,6 +68,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Logging - per-request details are DEBUG; set LOG_LEVEL=DEBUG to see them
+logging.basicConfig(format="%(message)s")
+log = logging.getLogger("hemascan")
+log.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
+# Intra-op threads per process; inter-op parallelism isn't used by ResNet inference
+torch.set_num_threads(TORCH_NUM_THREADS)
+try:
+    torch.set_num_interop_threads(1)
+except RuntimeError as e:
+    # Only settable before any inter-op work has run in this process
+    log.warning(f"⚠️ Could not set inter-op threads: {e}")
+
 # ==================== REQUEST MODELS ====================
 class ChatRequest(BaseModel):
     message: str
@@ -46,7 +89,7 @@ class ChatRequest(BaseModel):
 
 # ==================== LOAD MODEL ====================
 # Load config first (needed for preprocessing even if model fails)
-print("🔄 Loading configuration...")
+log.info("🔄 Loading configuration...")
 try:
     with open("models/config.json", "r") as f:
         config = json.load(f)
@@ -56,44 +99,63 @@ try:
     STD = config["std"]
     CLASSES = config["classes"]
     
-    print(f"✅ Configuration loaded!")
-    print(f"   - Classes: {CLASSES}")
-    print(f"   - Image size: {IMG_SIZE}x{IMG_SIZE}")
+    log.info(f"✅ Configuration loaded!")
+    log.info(f"   - Classes: {CLASSES}")
+    log.info(f"   - Image size: {IMG_SIZE}x{IMG_SIZE}")
 except Exception as e:
-    print(f"❌ Error loading config: {e}")
+    log.error(f"❌ Error loading config: {e}")
     # Fallback defaults
     IMG_SIZE = 224
     MEAN = [0.485, 0.456, 0.406]
     STD = [0.229, 0.224, 0.225]
     CLASSES = ["leukemia", "normal"]
-    print(f"⚠️ Using default values")
+    log.warning(f"⚠️ Using default values")
+
+# uint8 -> normalized float as one affine: x * SCALE + BIAS == (x/255 - MEAN) / STD
+SCALE = torch.tensor([1.0 / (255.0 * s) for s in STD]).view(3, 1, 1)
+BIAS = torch.tensor([-m / s for m, s in zip(MEAN, STD)]).view(3, 1, 1)
+
+# Inference precision for analysis: "fp32" (default), "int8" (static
+# quantization), "bf16" (Intel Extension for PyTorch + autocast) or
+# "onnx-int8" (ONNX Runtime with INT8 QDQ). The INT8 paths should be
+# calibrated on real smears placed in models/calibration before enabling them.
+INFERENCE_PRECISION = os.getenv("INFERENCE_PRECISION", "fp32").lower()
+
+# Opt-in: compile the FP32/BF16 model with torch.compile instead of TorchScript
+TORCH_COMPILE = os.getenv("TORCH_COMPILE", "0") == "1"
+
+# Largest batch the dynamic batcher will form
+MAX_BATCH_SIZE = 8
 
 # Load model
-print("🔄 Loading PyTorch model...")
-model = None
+CHECKPOINT_PATH = "models/leukemia_best.pt"
+log.info("🔄 Loading PyTorch model...")
+model = None       # Inference model (variant selected by INFERENCE_PRECISION)
+model_fp32 = None  # Full-precision model the inference variants are built from
 try:
-    # Create model architecture (ResNet18)
-    model = models.resnet18(weights=models.ResNet18_Weights.IMAGENET1K_V1)
+    # Create model architecture (ResNet18) - no pretrained weights, they are
+    # fully replaced by the trained checkpoint below
+    model_fp32 = models.resnet18(weights=None)
     
     # Modify final layer for binary classification
     num_classes = 2
-    in_features = model.fc.in_features
-    model.fc = nn.Linear(in_features, num_classes)
+    in_features = model_fp32.fc.in_features
+    model_fp32.fc = nn.Linear(in_features, num_classes)
     
-    # Load the trained weights
-    model.load_state_dict(torch.load("models/leukemia_best.pt", map_location="cpu"))
+    # Load the trained weights (mmap avoids reading the whole file up front)
+    model_fp32.load_state_dict(torch.load(CHECKPOINT_PATH, map_location="cpu", mmap=True, weights_only=True))
     
-    # Convert model to float32
-    model = model.float()
-    model.eval()
+    # Convert model to float32, NHWC (channels_last) for oneDNN's blocked conv kernels
+    model_fp32 = model_fp32.float().to(memory_format=torch.channels_last)
+    model_fp32.eval()
+    model = model_fp32
     
-    print(f"✅ Model loaded successfully!")
+    log.info(f"✅ Model loaded successfully!")
     
 except Exception as e:
-    print(f"❌ Error loading model: {e}")
-    import traceback
-    traceback.print_exc()
+    log.exception(f"❌ Error loading model: {e}")
     model = None
+    model_fp32 = None
 
 # ==================== UTILITIES ====================
 
@@ -101,47 +163,42 @@ def preprocess_image(image_bytes):
     """Convert uploaded image to model input tensor"""
     try:
         if not image_bytes or len(image_bytes) == 0:
-            print("❌ Preprocessing error: Empty image data")
+            log.error("❌ Preprocessing error: Empty image data")
             return None
         
-        print(f"📸 Preprocessing image: {len(image_bytes)} bytes")
-        
-        # Load image
-        try:
-            img = Image.open(io.BytesIO(image_bytes))
-            print(f"   Image format: {img.format}, Mode: {img.mode}, Size: {img.size}")
-        except Exception as e:
-            print(f"❌ Error opening image: {e}")
-            return None
-        
-        # Convert to RGB if needed
-        if img.mode != 'RGB':
-            print(f"   Converting from {img.mode} to RGB")
-            img = img.convert("RGB")
-        
-        # Resize
-        img = img.resize((IMG_SIZE, IMG_SIZE))
-        print(f"   Resized to: {IMG_SIZE}x{IMG_SIZE}")
+        # Decode with OpenCV (libjpeg-turbo/libpng/libtiff) straight to a uint8 array
+        img = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is not None:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        else:
+            # Fallback for formats OpenCV can't decode
+            try:
+                img = np.asarray(Image.open(io.BytesIO(image_bytes)).convert("RGB"))
+            except Exception as e:
+                log.error(f"❌ Error opening image: {e}")
+                return None
         
-        # Convert to numpy array
-        img_array = np.array(img).astype(np.float32) / 255.0
-        print(f"   Array shape: {img_array.shape}, Range: [{img_array.min():.3f}, {img_array.max():.3f}]")
+        # Resize (INTER_AREA: SIMD-accelerated, best quality for downscaling)
+        img = cv2.resize(img, (IMG_SIZE, IMG_SIZE), interpolation=cv2.INTER_AREA)
         
-        # Normalize using ImageNet statistics
-        img_array = (img_array - np.array(MEAN)) / np.array(STD)
-        print(f"   Normalized range: [{img_array.min():.3f}, {img_array.max():.3f}]")
+        # HWC uint8 array viewed as a 1xCxHxW tensor (already NHWC in memory)
+        img_tensor = torch.from_numpy(img).permute(2, 0, 1)
         
-        # Convert to tensor (NCHW format) with float32 dtype
-        img_tensor = torch.from_numpy(img_array).permute(2, 0, 1).unsqueeze(0).float()
-        print(f"✅ Preprocessing successful: tensor shape {img_tensor.shape}, dtype {img_tensor.dtype}")
+        # Add batch dim and convert to float NHWC (channels_last) in one copy,
+        # then scale + normalize with one fused in-place affine
+        img_tensor = img_tensor.unsqueeze(0).to(dtype=torch.float32, memory_format=torch.channels_last)
+        img_tensor = img_tensor.mul_(SCALE).add_(BIAS)
         
         return img_tensor
     except Exception as e:
-        print(f"❌ Preprocessing error: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception(f"❌ Preprocessing error: {e}")
         return None
 
+@functools.lru_cache(maxsize=None)
+def ensure_dir(path):
+    """Create an output directory once per process instead of on every request"""
+    Path(path).mkdir(parents=True, exist_ok=True)
+
 def save_report(diagnosis, confidence):
     """Save analysis report to file (or return in-memory for Lambda)"""
     timestamp = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
@@ -157,94 +214,452 @@ def save_report(diagnosis, confidence):
     # For EB/local: save to file
     if os.getenv("AWS_LAMBDA_FUNCTION_NAME"):
         # Running on Lambda - don't save files
-        print(f"✅ Report generated: {timestamp}")
+        log.debug(f"✅ Report generated: {timestamp}")
     else:
         # Running on EB/local - save to file
-        Path("results/analysis").mkdir(parents=True, exist_ok=True)
+        ensure_dir("results/analysis")
         filepath = f"results/analysis/report_{timestamp}.json"
         with open(filepath, "w") as f:
             json.dump(report, f, indent=2)
-        print(f"✅ Report saved: {filepath}")
+        log.debug(f"✅ Report saved: {filepath}")
     
     return report
 
+_DENORM_MEAN = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+_DENORM_STD = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+
+@functools.lru_cache(maxsize=4)
+def _denorm_stats(device):
+    """Denormalization mean/std, moved to each device once"""
+    return _DENORM_MEAN.to(device, non_blocking=True), _DENORM_STD.to(device, non_blocking=True)
+
 def denorm(batch):
     """Denormalize image tensor back to 0-1 range (from hemascanmodel.py)"""
-    mean = torch.tensor([0.485, 0.456, 0.406], device=batch.device).view(1, 3, 1, 1)
-    std = torch.tensor([0.229, 0.224, 0.225], device=batch.device).view(1, 3, 1, 1)
+    mean, std = _denorm_stats(batch.device)
     return torch.clamp(batch * std + mean, 0, 1)
 
+# JET colormap as a (256, 3) uint8 RGB lookup table
+JET_LUT = cv2.cvtColor(
+    cv2.applyColorMap(np.arange(256, dtype=np.uint8).reshape(-1, 1), cv2.COLORMAP_JET),
+    cv2.COLOR_BGR2RGB,
+).reshape(256, 3)
+
+def fast_overlay(rgb_u8, grayscale_cam):
+    """Blend a Grad CAM heatmap onto a uint8 RGB image; returns uint8 HWC RGB"""
+    # Medical imaging standard: normalize CAM to the full range for better visibility
+    cam_min, cam_max, _, _ = cv2.minMaxLoc(grayscale_cam)
+    if cam_max > cam_min:
+        # Truncate (not round) to uint8, as show_cam_on_image does
+        cam_u8 = ((grayscale_cam - cam_min) * (255 / (cam_max - cam_min))).astype(np.uint8)
+    else:
+        # Flat CAM: mid-scale fill rather than all-zero (solid blue) overlay
+        cam_u8 = np.full(grayscale_cam.shape, 128, dtype=np.uint8)
+    heatmap = JET_LUT[cam_u8]
+    vis = cv2.addWeighted(rgb_u8, 0.5, heatmap, 0.5, 0, dtype=cv2.CV_32F)
+    # Rescale so the brightest pixel is 255, as show_cam_on_image does (matches training colours)
+    return cv2.normalize(vis, None, alpha=255, norm_type=cv2.NORM_INF, dtype=cv2.CV_8U)
+
 def generate_gradcam(image_tensor, model_output_idx):
     """Generate Grad CAM visualization - Medical Imaging Best Practices"""
     try:
-        target_layer = model.layer4[-1]
-        
-        with GradCAM(model=model, target_layers=[target_layer]) as cam:
-            with torch.no_grad():
-                logits = model(image_tensor)
-            pred = int(torch.argmax(logits, dim=1).item())
-            grayscale_cam = cam(input_tensor=image_tensor, targets=[ClassifierOutputTarget(pred)])[0]
+        # GradCAM runs its own forward pass; target the class predicted by the caller.
+        # The shared GRADCAM stores activations/gradients, so one call at a time.
+        with GRADCAM_LOCK:
+            grayscale_cam = GRADCAM(input_tensor=image_tensor, targets=[ClassifierOutputTarget(model_output_idx)])[0]
         
-        # Proper normalization: ensure values are in [0,1] range
-        # Medical imaging standard: normalize to full range for better visibility
-        cam_min = grayscale_cam.min()
-        cam_max = grayscale_cam.max()
-        
-        if cam_max > cam_min:
-            grayscale_cam = (grayscale_cam - cam_min) / (cam_max - cam_min)
-        else:
-            grayscale_cam = np.ones_like(grayscale_cam) * 0.5
+        # Denormalize original image to uint8 HWC (NHWC input makes this a plain view)
+        rgb_img = denorm(image_tensor)[0].permute(1, 2, 0).mul(255).to(torch.uint8).numpy()
         
-        # Denormalize original image
-        rgb_img = denorm(image_tensor).squeeze(0).permute(1, 2, 0).cpu().numpy()
-        rgb_img = np.clip(rgb_img, 0, 1)
+        # Create overlay using medical imaging standard colormap (JET, 50/50 blend)
+        vis = fast_overlay(rgb_img, grayscale_cam)
         
-        # Create overlay using medical imaging standard colormap
-        # The show_cam_on_image function uses a fixed blend ratio internally
-        vis = show_cam_on_image(rgb_img, grayscale_cam, use_rgb=True)
-        
-        print(f"✅ Grad CAM generated - original range: [{cam_min:.3f}, {cam_max:.3f}], normalized: [{grayscale_cam.min():.3f}, {grayscale_cam.max():.3f}]")
+        log.debug(f"✅ Grad CAM generated")
         
         return grayscale_cam, vis, rgb_img
     except Exception as e:
-        print(f"❌ Grad CAM error: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception(f"❌ Grad CAM error: {e}")
         return None, None, None
 
+OVERLAY_WEBP_QUALITY = 85
+
 def save_gradcam_overlay(timestamp, overlay_image):
     """Save only Grad CAM overlay - Medical Imaging Best Practice"""
     try:
-        import cv2
-        
-        # Convert overlay from RGB to BGR for cv2 (overlay_image is already in [0,1] range)
-        overlay_bgr = cv2.cvtColor((overlay_image * 255).astype(np.uint8), cv2.COLOR_RGB2BGR)
-        
-        # For Lambda: encode directly to base64 without saving
-        # For EB/local: save to file then encode
+        # Convert overlay from RGB to BGR for cv2 (overlay_image is uint8 HWC)
+        overlay_bgr = cv2.cvtColor(overlay_image, cv2.COLOR_RGB2BGR)
+        
+        # Lossy WebP is much faster to encode than PNG and gives a smaller payload;
+        # the overlay is a visualization, not a diagnostic source image
+        ok, buffer = cv2.imencode('.webp', overlay_bgr, [cv2.IMWRITE_WEBP_QUALITY, OVERLAY_WEBP_QUALITY])
+        if not ok:
+            raise RuntimeError("WebP encoding failed")
+        overlay_base64 = base64.b64encode(buffer).decode('utf-8')
+        overlay_url = f"data:image/webp;base64,{overlay_base64}"
+        
+        # For Lambda: return the encoded image without saving
+        # For EB/local: also save the encoded bytes to file
         if os.getenv("AWS_LAMBDA_FUNCTION_NAME"):
-            # Lambda: encode directly from memory
-            _, buffer = cv2.imencode('.png', overlay_bgr)
-            overlay_base64 = base64.b64encode(buffer).decode('utf-8')
-            overlay_url = f"data:image/png;base64,{overlay_base64}"
-            print(f"✅ Grad CAM overlay encoded")
+            log.debug(f"✅ Grad CAM overlay encoded")
         else:
-            # EB/local: save to file then encode
-            Path("results/overlays").mkdir(parents=True, exist_ok=True)
-            overlay_path = f"results/overlays/overlay_{timestamp}.png"
-            cv2.imwrite(overlay_path, overlay_bgr)
-            with open(overlay_path, 'rb') as f:
-                overlay_base64 = base64.b64encode(f.read()).decode('utf-8')
-            overlay_url = f"data:image/png;base64,{overlay_base64}"
-            print(f"✅ Grad CAM overlay saved: {overlay_path}")
+            ensure_dir("results/overlays")
+            overlay_path = f"results/overlays/overlay_{timestamp}.webp"
+            with open(overlay_path, 'wb') as f:
+                f.write(buffer.tobytes())
+            log.debug(f"✅ Grad CAM overlay saved: {overlay_path}")
         
         return overlay_url
     except Exception as e:
-        print(f"❌ Error saving Grad CAM: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception(f"❌ Error saving Grad CAM: {e}")
         return None
 
+# ==================== QUANTIZATION ====================
+# INT8 static quantization (fbgemm) of the inference model. Calibration runs
+# once; the converted weights are cached (keyed on the FP32 checkpoint's hash)
+# so later boots load them directly.
+CALIBRATION_DIR = "models/calibration"
+NUM_CALIBRATION_SAMPLES = 50
+
+@functools.lru_cache(maxsize=None)
+def checkpoint_digest():
+    """Short content hash of the FP32 checkpoint, used to key derived artifacts"""
+    digest = hashlib.blake2b(digest_size=8)
+    with open(CHECKPOINT_PATH, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def quantized_model_path():
+    """INT8 cache file for the current checkpoint"""
+    return f"models/leukemia_best.{checkpoint_digest()}.int8.pt"
+
+def calibration_batches():
+    """Yield calibration tensors: local sample images if present, else synthetic"""
+    calib_dir = Path(CALIBRATION_DIR)
+    count = 0
+    if calib_dir.is_dir():
+        for image_path in sorted(calib_dir.iterdir()):
+            if count >= NUM_CALIBRATION_SAMPLES:
+                return
+            image_tensor = preprocess_image(image_path.read_bytes())
+            if image_tensor is not None:
+                count += 1
+                yield image_tensor
+    
+    # Synthetic fallback: random uint8 RGB images normalized like real inputs.
+    # Seeded so every instance derives the same quantized model.
+    if count < NUM_CALIBRATION_SAMPLES:
+        log.warning(f"⚠️ Only {count} calibration images in {CALIBRATION_DIR}, "
+                    f"using {NUM_CALIBRATION_SAMPLES - count} synthetic samples (INT8 accuracy may suffer)")
+    generator = torch.Generator().manual_seed(0)
+    for _ in range(NUM_CALIBRATION_SAMPLES - count):
+        pixels = torch.randint(0, 256, (1, 3, IMG_SIZE, IMG_SIZE), dtype=torch.uint8, generator=generator)
+        yield pixels.to(torch.float32).mul_(SCALE).add_(BIAS)
+
+def quantize_model(fp32_model):
+    """Return an INT8 statically-quantized copy of the FP32 ResNet18"""
+    torch.backends.quantized.engine = "fbgemm"
+    
+    # The quantizable ResNet18 variant adds quant/dequant stubs and
+    # quantization-friendly residual adds; parameter names match resnet18
+    qmodel = quantizable_models.resnet18(weights=None, quantize=False)
+    qmodel.fc = nn.Linear(qmodel.fc.in_features, fp32_model.fc.out_features)
+    qmodel.eval()
+    
+    cache_path = quantized_model_path()
+    cached = Path(cache_path).exists()
+    if not cached:
+        qmodel.load_state_dict(fp32_model.state_dict())
+    
+    # Fuse (conv, bn, relu) triples, then insert observers
+    qmodel.fuse_model()
+    qmodel.qconfig = torch.ao.quantization.get_default_qconfig("fbgemm")
+    torch.ao.quantization.prepare(qmodel, inplace=True)
+    
+    if cached:
+        torch.ao.quantization.convert(qmodel, inplace=True)
+        qmodel.load_state_dict(torch.load(cache_path, map_location="cpu"))
+        log.info(f"✅ Loaded cached INT8 model: {cache_path}")
+        return qmodel
+    
+    with torch.no_grad():
+        for calib in calibration_batches():
+            qmodel(calib)
+    torch.ao.quantization.convert(qmodel, inplace=True)
+    
+    log.info(f"✅ Model quantized to INT8")
+    
+    # Cache is best-effort: read-only deploys (Lambda) recalibrate each cold start,
+    # deterministically, so all instances still serve the same model
+    try:
+        torch.save(qmodel.state_dict(), cache_path)
+        log.info(f"✅ INT8 model cached: {cache_path}")
+    except OSError as e:
+        log.warning(f"⚠️ Could not cache INT8 model: {e}")
+    return qmodel
+
+if model_fp32 is not None and INFERENCE_PRECISION == "int8":
+    log.info("🔄 Quantizing model to INT8...")
+    try:
+        model = quantize_model(model_fp32)
+    except Exception as e:
+        # Keep serving with FP32 (e.g. CPUs without fbgemm support)
+        log.warning(f"⚠️ INT8 quantization failed, using FP32 model: {e}")
+        model = model_fp32
+        INFERENCE_PRECISION = "fp32"
+
+# ==================== BF16 (IPEX) ====================
+# BF16 weights + autocast via Intel Extension for PyTorch (AVX-512 BF16 / AMX).
+# ipex.optimize returns a copy, so model_fp32 itself stays FP32.
+if model_fp32 is not None and INFERENCE_PRECISION == "bf16":
+    if ipex is None:
+        log.warning("⚠️ intel_extension_for_pytorch not installed, using FP32 model")
+        INFERENCE_PRECISION = "fp32"
+    else:
+        log.info("🔄 Optimizing model for BF16 with IPEX...")
+        try:
+            model = ipex.optimize(
+                model_fp32,
+                dtype=torch.bfloat16,
+                sample_input=torch.randn(1, 3, IMG_SIZE, IMG_SIZE).contiguous(memory_format=torch.channels_last),
+            )
+            log.info(f"✅ Model optimized for BF16")
+        except Exception as e:
+            log.warning(f"⚠️ BF16 optimization failed, using FP32 model: {e}")
+            model = model_fp32
+            INFERENCE_PRECISION = "fp32"
+
+def inference_autocast():
+    """Autocast context for the inference model (BF16 only, never for Grad CAM)"""
+    if INFERENCE_PRECISION == "bf16":
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+# ==================== ONNX RUNTIME (INT8 QDQ) ====================
+# Export once to ONNX, quantize statically to INT8 (QDQ format) and serve the
+# analyze path from an ONNX Runtime session; Grad CAM keeps the torch model.
+# Artifacts are keyed on the FP32 checkpoint's hash, like the torch INT8 cache.
+def onnx_model_paths():
+    """(FP32, INT8) ONNX file paths for the current checkpoint"""
+    stem = f"models/leukemia_best.{checkpoint_digest()}"
+    return f"{stem}.onnx", f"{stem}.int8.onnx"
+
+if ort is not None:
+    class OnnxCalibrationReader(CalibrationDataReader):
+        """Feed calibration tensors to onnxruntime's static quantizer"""
+        
+        def __init__(self):
+            self.batches = calibration_batches()
+        
+        def get_next(self):
+            batch = next(self.batches, None)
+            return None if batch is None else {"x": batch.contiguous().numpy()}
+
+class OnnxModel:
+    """Callable wrapper so an ONNX Runtime session stands in for the torch model"""
+    
+    def __init__(self, session):
+        self.session = session
+    
+    def __call__(self, batch):
+        logits = self.session.run(None, {"x": batch.contiguous().numpy()})[0]
+        return torch.from_numpy(logits)
+
+def build_onnx_model(fp32_model):
+    """Export (if needed), quantize and load the INT8 ONNX model"""
+    onnx_path, onnx_int8_path = onnx_model_paths()
+    if not Path(onnx_int8_path).exists():
+        example = torch.randn(1, 3, IMG_SIZE, IMG_SIZE)
+        torch.onnx.export(
+            fp32_model,
+            example,
+            onnx_path,
+            opset_version=17,
+            input_names=["x"],
+            output_names=["logits"],
+            dynamic_axes={"x": {0: "batch"}, "logits": {0: "batch"}},
+        )
+        quantize_static(
+            onnx_path,
+            onnx_int8_path,
+            OnnxCalibrationReader(),
+            quant_format=QuantFormat.QDQ,
+            per_channel=True,
+        )
+        log.info(f"✅ INT8 ONNX model written: {onnx_int8_path}")
+    
+    opts = ort.SessionOptions()
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    opts.intra_op_num_threads = TORCH_NUM_THREADS
+    session = ort.InferenceSession(onnx_int8_path, sess_options=opts, providers=["CPUExecutionProvider"])
+    return OnnxModel(session)
+
+if model_fp32 is not None and INFERENCE_PRECISION == "onnx-int8":
+    if ort is None:
+        log.warning("⚠️ onnxruntime not installed, using FP32 model")
+        INFERENCE_PRECISION = "fp32"
+    else:
+        log.info("🔄 Building INT8 ONNX Runtime session...")
+        try:
+            model = build_onnx_model(model_fp32)
+            log.info(f"✅ ONNX Runtime session ready")
+        except Exception as e:
+            log.warning(f"⚠️ ONNX Runtime setup failed, using FP32 model: {e}")
+            model = model_fp32
+            INFERENCE_PRECISION = "fp32"
+
+# ==================== TORCHSCRIPT ====================
+# Trace + freeze the inference model once so conv/bn/relu are fused and
+# constants folded; Grad CAM keeps the eager FP32 model for its hooks.
+def trace_model(eager_model):
+    """Return a frozen, inference-optimized TorchScript version of the model"""
+    example = torch.randn(1, 3, IMG_SIZE, IMG_SIZE).contiguous(memory_format=torch.channels_last)
+    with torch.inference_mode(), inference_autocast():
+        traced = torch.jit.trace(eager_model, example)
+    traced = torch.jit.freeze(traced)
+    traced = torch.jit.optimize_for_inference(traced)
+    
+    # Warm up: the first calls run the profiling/fusion passes
+    with torch.inference_mode(), inference_autocast():
+        for _ in range(2):
+            traced(example)
+    return traced
+
+# ==================== TORCH.COMPILE ====================
+# Inductor specializes on the fixed input shape and fuses ops into generated
+# kernels. Every batch size the batcher can form is compiled at startup so no
+# request pays the compile cost. Grad CAM keeps the uncompiled FP32 model.
+def compile_model(eager_model):
+    """Return a shape-specialized torch.compile version of the model"""
+    # One specialized graph per batch size; make sure they all stay cached
+    torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 2 * MAX_BATCH_SIZE)
+    compiled = torch.compile(eager_model, mode="reduce-overhead", dynamic=False, fullgraph=True)
+    with torch.inference_mode(), inference_autocast():
+        for batch_size in range(1, MAX_BATCH_SIZE + 1):
+            example = torch.randn(batch_size, 3, IMG_SIZE, IMG_SIZE).contiguous(memory_format=torch.channels_last)
+            for _ in range(2):
+                compiled(example)
+    return compiled
+
+if model is not None and INFERENCE_PRECISION != "onnx-int8":
+    if TORCH_COMPILE and INFERENCE_PRECISION in ("fp32", "bf16"):
+        log.info("🔄 Compiling model with torch.compile...")
+        try:
+            model = compile_model(model)
+            log.info(f"✅ Model compiled")
+        except Exception as e:
+            log.warning(f"⚠️ torch.compile failed, using eager model: {e}")
+    else:
+        if TORCH_COMPILE:
+            log.warning(f"⚠️ torch.compile is not supported for {INFERENCE_PRECISION}, tracing instead")
+        log.info("🔄 Tracing model with TorchScript...")
+        try:
+            model = trace_model(model)
+            log.info(f"✅ Model traced and frozen")
+        except Exception as e:
+            log.warning(f"⚠️ TorchScript tracing failed, using eager model: {e}")
+
+# ==================== GRAD CAM ====================
+# Grad CAM is built once, after the inference model is final, so its hooks on
+# layer4[-1] are registered a single time and never get traced/compiled into
+# the inference model. It hooks the eager FP32 model (it needs gradients); a
+# copy is only needed when that same module is still serving inference.
+GRADCAM = None
+GRADCAM_LOCK = threading.Lock()
+if model_fp32 is not None:
+    model_for_cam = copy.deepcopy(model_fp32) if model is model_fp32 else model_fp32
+    GRADCAM = GradCAM(model=model_for_cam, target_layers=[model_for_cam.layer4[-1]])
+    atexit.register(GRADCAM.__exit__, None, None, None)
+
+# ==================== DYNAMIC BATCHING ====================
+# Concurrent requests are coalesced into one batched forward pass, amortizing
+# per-call dispatch overhead across images.
+class DynamicBatcher:
+    """Queue single-image requests and run them through the model in batches"""
+    
+    def __init__(self, model, max_batch=MAX_BATCH_SIZE, max_wait_ms=25):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = None
+        self.loop = None
+        self._task = None  # Strong reference so the worker isn't garbage-collected
+    
+    async def predict(self, image_tensor):
+        """Queue a (3, H, W) tensor and wait for its (num_classes,) logits"""
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            # (Re)start the worker on the current event loop
+            self.loop = loop
+            self.queue = asyncio.Queue()
+            self._task = loop.create_task(self._worker(self.queue))
+        
+        future = loop.create_future()
+        await self.queue.put((image_tensor, future))
+        return await future
+    
+    async def _worker(self, queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            await self._process_batch(batch)
+    
+    def _run_batch(self, tensors):
+        """Stack and run one forward pass (called in a worker thread)"""
+        with torch.inference_mode(), inference_autocast():
+            batch_tensor = torch.stack(tensors).contiguous(memory_format=torch.channels_last)
+            return self.model(batch_tensor).float()
+    
+    async def _process_batch(self, batch):
+        tensors, futures = zip(*batch)
+        try:
+            # Off the event loop so other requests keep being accepted meanwhile
+            logits = await asyncio.to_thread(self._run_batch, tensors)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        for i, future in enumerate(futures):
+            if not future.done():
+                future.set_result(logits[i])
+
+batcher = DynamicBatcher(model, max_batch=MAX_BATCH_SIZE) if model is not None else None
+
+# ==================== ANALYSIS CACHE ====================
+# The client calls /api/generate-gradcam right after /api/analyze with the same
+# file; keying on a content hash lets Grad CAM reuse the preprocessed tensor
+# and prediction instead of preprocessing and running the model again.
+ANALYSIS_CACHE_SIZE = 64
+_analysis_cache = collections.OrderedDict()
+
+def image_digest(image_bytes):
+    """Content hash of an uploaded image (blake2b is faster than SHA-2)"""
+    return hashlib.blake2b(image_bytes, digest_size=16).digest()
+
+def cache_analysis(digest, image_tensor, pred_idx):
+    """Remember an analysis result, evicting the least recently used entry"""
+    _analysis_cache[digest] = (image_tensor, pred_idx)
+    _analysis_cache.move_to_end(digest)
+    while len(_analysis_cache) > ANALYSIS_CACHE_SIZE:
+        _analysis_cache.popitem(last=False)
+
+def get_cached_analysis(digest):
+    """Return (image_tensor, pred_idx) for a digest, or None"""
+    entry = _analysis_cache.get(digest)
+    if entry is not None:
+        _analysis_cache.move_to_end(digest)
+    return entry
+
 # ==================== ENDPOINTS ====================
 
 @app.get("/")
@@ -297,7 +712,7 @@ async def login(username: str, password: str):
 # ==================== ANALYSIS ====================
 
 @app.post("/api/analyze")
-async def analyze(file: UploadFile = File(...)):
+async def analyze(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
     """
     Analyze blood smear image with PyTorch model
     Returns: diagnosis + confidence score + Grad CAM visualizations
@@ -309,36 +724,39 @@ async def analyze(file: UploadFile = File(...)):
         
         # Check if model is loaded
         if model is None:
-            print("❌ Model not loaded - cannot perform analysis")
+            log.error("❌ Model not loaded - cannot perform analysis")
             return {
                 "error": "Model not available. Please check Lambda logs for model loading errors.",
                 "details": "The PyTorch model failed to load during Lambda initialization"
             }
         
-        print(f"📸 Processing image: {file.filename}")
-        print(f"   File type: {file.content_type}")
+        log.debug(f"📸 Processing image: {file.filename}")
+        log.debug(f"   File type: {file.content_type}")
         
         # Read uploaded image
         image_data = await file.read()
-        print(f"   File size: {len(image_data)} bytes")
+        log.debug(f"   File size: {len(image_data)} bytes")
         
         # Preprocess
-        image_tensor = preprocess_image(image_data)
+        image_tensor = await asyncio.to_thread(preprocess_image, image_data)
         if image_tensor is None:
-            print("❌ Preprocessing returned None - check logs above for details")
+            log.error("❌ Preprocessing returned None - check logs above for details")
             return {
                 "error": "Failed to preprocess image. Please ensure the image is a valid JPEG, PNG, or TIFF file.",
                 "details": "Check Lambda logs for specific preprocessing error"
             }
         
-        # Run inference
-        with torch.no_grad():
-            logits = model(image_tensor)
-            probs = torch.softmax(logits, dim=1)[0]
-            
-            confidence = probs.max().item() * 100
-            pred_idx = probs.argmax().item()
-            diagnosis = CLASSES[pred_idx]
+        # Run inference (batched with concurrent requests)
+        logits = await batcher.predict(image_tensor.squeeze(0))
+        
+        # Softmax preserves order, so argmax over logits gives the prediction; for
+        # two classes the winning softmax probability is sigmoid(logit difference)
+        pred_idx = int(logits.argmax())
+        diag_logit, other_logit = logits[pred_idx], logits[1 - pred_idx]
+        confidence = float(torch.sigmoid(diag_logit - other_logit)) * 100
+        diagnosis = CLASSES[pred_idx]
+        
+        cache_analysis(image_digest(image_data), image_tensor, pred_idx)
         
         # Format diagnosis nicely
         if diagnosis.lower() == "leukemia":
@@ -346,7 +764,7 @@ async def analyze(file: UploadFile = File(...)):
         else:
             diagnosis_text = "🟢 Normal Blood Smear"
         
-        print(f"✅ Analysis complete: {diagnosis_text} ({confidence:.1f}%)")
+        log.debug(f"✅ Analysis complete: {diagnosis_text} ({confidence:.1f}%)")
         
         # Initialize response (NO GRAD CAM HERE - just diagnosis)
         result = {
@@ -355,15 +773,13 @@ async def analyze(file: UploadFile = File(...)):
             "timestamp": datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
         }
         
-        # Save report
-        save_report(diagnosis_text, confidence)
+        # Save report after the response is sent (not on the client's critical path)
+        background_tasks.add_task(save_report, diagnosis_text, confidence)
         
         return result
         
     except Exception as e:
-        print(f"❌ Analysis error: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception(f"❌ Analysis error: {e}")
         return {"error": str(e)}
 
 # ==================== GRAD CAM (SEPARATE ENDPOINT) ====================
@@ -377,35 +793,40 @@ async def generate_gradcam_endpoint(file: UploadFile = File(...)):
     try:
         # Check if model is loaded
         if model is None:
-            print("❌ Model not loaded - cannot generate Grad CAM")
+            log.error("❌ Model not loaded - cannot generate Grad CAM")
             return {
                 "error": "Model not available. Please check Lambda logs for model loading errors.",
                 "details": "The PyTorch model failed to load during Lambda initialization"
             }
         
-        print(f"🎯 Generating Grad CAM for: {file.filename}")
+        log.debug(f"🎯 Generating Grad CAM for: {file.filename}")
         
         # Read uploaded image
         image_data = await file.read()
         
-        # Preprocess
-        image_tensor = preprocess_image(image_data)
-        if image_tensor is None:
-            print("❌ Preprocessing returned None - check logs above for details")
-            return {
-                "error": "Failed to preprocess image. Please ensure the image is a valid JPEG, PNG, or TIFF file.",
-                "details": "Check Lambda logs for specific preprocessing error"
-            }
-        
-        # Get prediction
-        with torch.no_grad():
-            logits = model(image_tensor)
-            pred_idx = logits.argmax(dim=1).item()
+        # Reuse preprocessing + prediction from /api/analyze when available
+        cached = get_cached_analysis(image_digest(image_data))
+        if cached is not None:
+            image_tensor, pred_idx = cached
+            log.debug("   Reusing cached analysis")
+        else:
+            # Preprocess
+            image_tensor = await asyncio.to_thread(preprocess_image, image_data)
+            if image_tensor is None:
+                log.error("❌ Preprocessing returned None - check logs above for details")
+                return {
+                    "error": "Failed to preprocess image. Please ensure the image is a valid JPEG, PNG, or TIFF file.",
+                    "details": "Check Lambda logs for specific preprocessing error"
+                }
+            
+            # Get prediction
+            logits = await batcher.predict(image_tensor.squeeze(0))
+            pred_idx = logits.argmax().item()
         
         # Generate Grad CAM
-        print(f"🎯 Generating Grad CAM visualization...")
+        log.debug(f"🎯 Generating Grad CAM visualization...")
         timestamp = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
-        grayscale_cam, overlay_image, rgb_img = generate_gradcam(image_tensor, pred_idx)
+        grayscale_cam, overlay_image, rgb_img = await asyncio.to_thread(generate_gradcam, image_tensor, pred_idx)
         
         # Initialize response
         result = {
@@ -414,7 +835,7 @@ async def generate_gradcam_endpoint(file: UploadFile = File(...)):
         
         # Save only overlay (best practice for medical imaging)
         if overlay_image is not None:
-            overlay_url = save_gradcam_overlay(timestamp, overlay_image)
+            overlay_url = await asyncio.to_thread(save_gradcam_overlay, timestamp, overlay_image)
             if overlay_url:
                 result["overlayImageUrl"] = overlay_url
                 # For backward compatibility, set heatmapImageUrl to same as overlay
@@ -423,9 +844,7 @@ async def generate_gradcam_endpoint(file: UploadFile = File(...)):
         return result
         
     except Exception as e:
-        print(f"❌ Grad CAM error: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception(f"❌ Grad CAM error: {e}")
         return {"error": str(e)}
 
 # ==================== CHAT ====================
@@ -471,7 +890,7 @@ async def chat(request: ChatRequest):
         }
         
     except Exception as e:
-        print(f"❌ Chat error: {e}")
+        log.error(f"❌ Chat error: {e}")
         return {"error": str(e)}
 
 # ==================== RUN ====================